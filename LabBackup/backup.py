@@ -7,6 +7,12 @@ import re
 import requests
 import json
 import datetime
+import math
+import selectors
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 import tomlkit
 from tomlkit import document, table, comment, dumps
@@ -15,17 +21,32 @@ from tomlkit import document, table, comment, dumps
 from colorama import Fore
 from colorama import Style
 
-from subprocess import PIPE, run, DEVNULL, TimeoutExpired
-from csv import DictReader, DictWriter
+from subprocess import PIPE, run, DEVNULL, TimeoutExpired, Popen, CompletedProcess
+from csv import DictWriter
 from pathlib import Path
 
+# the roster module is shared with MUCSMake and lives alongside both tools
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "Shared"))
+from roster import FIELDNAMES, load_roster_columns, read_roster
+from valgrind import run_valgrind
+from similarity import SimilarityIndex, locked
+
+# inotify is optional. Without it, watch mode falls back to polling the submissions directory.
+# https://pypi.org/project/inotify-simple/
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
 
 class Config:
     def __init__(self, class_code, execution_timeout, roster_invalidation_days, use_header_files, use_makefile,
                  compile_submissions, execute_submissions, generate_valgrind_output, clear_existing_backups,
-                 input_string, check_attendance,
-                 local_storage_dir, hellbender_lab_dir, cache_dir, api_prefix, api_token, course_id,
-                 attendance_assignment_name_scheme, attendance_assignment_point_criterion):
+                 input_string, check_attendance, watch_poll_interval, attendance_refresh_minutes, valgrind_workers, output_stall_timeout,
+                 build_similarity_index, similarity_threshold,
+                 local_storage_dir, hellbender_lab_dir, cache_dir, similarity_index_dir, api_prefix, api_token, course_id,
+                 attendance_assignment_name_scheme, attendance_assignment_point_criterion, bulk_attendance,
+                 attendance_invalidation_hours):
         # general
         self.class_code = class_code
         self.execution_timeout = execution_timeout
@@ -38,16 +59,25 @@ class Config:
         self.clear_existing_backups = clear_existing_backups
         self.input_string = input_string
         self.check_attendance = check_attendance
+        self.watch_poll_interval = watch_poll_interval
+        self.attendance_refresh_minutes = attendance_refresh_minutes
+        self.valgrind_workers = valgrind_workers
+        self.output_stall_timeout = output_stall_timeout
+        self.build_similarity_index = build_similarity_index
+        self.similarity_threshold = similarity_threshold
         # paths
         self.local_storage_dir = local_storage_dir
         self.hellbender_lab_dir = hellbender_lab_dir
         self.cache_dir = cache_dir
+        self.similarity_index_dir = similarity_index_dir
         # canvas
         self.api_prefix = api_prefix
         self.api_token = api_token
         self.course_id = course_id
         self.attendance_assignment_name_scheme = attendance_assignment_name_scheme
         self.attendance_assignment_point_criterion = attendance_assignment_point_criterion
+        self.bulk_attendance = bulk_attendance
+        self.attendance_invalidation_hours = attendance_invalidation_hours
 
     def get_complete_hellbender_path(self):
         return self.hellbender_lab_dir + self.class_code
@@ -58,6 +88,17 @@ class Config:
     def get_complete_cache_path(self):
         return self.get_complete_local_path() + "/" + self.cache_dir
 
+    # kept outside the cache folder since the cache is rebuilt on every run
+    def get_attendance_matrix_path(self):
+        return self.get_complete_local_path() + "/attendance_matrix.json"
+
+    def get_student_history_path(self):
+        return self.get_complete_local_path() + "/student_history.json"
+
+    # shared between every grader's sections so matches can be found across them
+    def get_similarity_index_path(self, lab_name):
+        return self.similarity_index_dir + self.class_code + "/" + lab_name + ".json"
+
 
 class CommandArgs:
     def __init__(self, lab_name, grader_name):
@@ -69,6 +110,120 @@ class Context:
     def __init__(self, config_obj, command_args_obj):
         self.config_obj = config_obj
         self.command_args_obj = command_args_obj
+        self.attendance_matrix = None
+        self.student_history = None
+
+
+# Attendance scores for every student across every lab, filled from a single Canvas export.
+# Labs are keyed by the part of the attendance assignment's name after the naming scheme (e.g. lab_name[3:]).
+# Scores are stored row-major in one flat array, one row per student, with NaN for missing submissions.
+class AttendanceMatrix:
+    def __init__(self, labs, date):
+        self.labs = list(labs)
+        self.date = date
+        self.student_ids = []
+        self.scores = array('d')
+        self._lab_index = {lab: i for i, lab in enumerate(self.labs)}
+        self._student_index = {}
+
+    def has_lab(self, lab):
+        return lab in self._lab_index
+
+    def set_score(self, lab, user_id, score):
+        row = self._student_index.get(user_id)
+        if row is None:
+            row = len(self.student_ids)
+            self._student_index[user_id] = row
+            self.student_ids.append(user_id)
+            self.scores.extend([math.nan] * len(self.labs))
+        self.scores[row * len(self.labs) + self._lab_index[lab]] = math.nan if score is None else score
+
+    def get_score(self, lab, user_id):
+        row = self._student_index.get(int(user_id))
+        column = self._lab_index.get(lab)
+        if row is None or column is None:
+            return None
+        score = self.scores[row * len(self.labs) + column]
+        return None if math.isnan(score) else score
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'date': str(self.date), 'labs': self.labs, 'student_ids': self.student_ids,
+                       'scores': [None if math.isnan(score) else score for score in self.scores]}, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        matrix = cls(data['labs'], datetime.datetime.strptime(data['date'], "%Y-%m-%d %H:%M:%S.%f"))
+        matrix.student_ids = data['student_ids']
+        matrix._student_index = {user_id: i for i, user_id in enumerate(matrix.student_ids)}
+        matrix.scores = array('d', (math.nan if score is None else score for score in data['scores']))
+        return matrix
+
+
+# How past compile and run times for each student are tracked from lab to lab.
+# Durations are exponentially weighted so recent labs count the most.
+# A student is timeout-prone once at least half of their recorded runs have timed out.
+class StudentHistory:
+    weight = 0.5
+    timeout_prone_ratio = 0.5
+
+    def __init__(self, path, records=None):
+        self.path = path
+        self.records = records if records is not None else {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return cls(path, json.load(file))
+        except (OSError, ValueError):
+            return cls(path)
+
+    def save(self):
+        with self._lock, open(self.path, 'w', encoding='utf-8') as file:
+            json.dump(self.records, file)
+
+    def record(self, pawprint, compile_seconds, run_seconds, timed_out):
+        with self._lock:
+            record = self.records.get(pawprint)
+            if record is None:
+                self.records[pawprint] = {'compile': compile_seconds, 'run': run_seconds, 'runs': 1,
+                                          'timeouts': int(timed_out)}
+                return
+            record['compile'] += self.weight * (compile_seconds - record['compile'])
+            record['run'] += self.weight * (run_seconds - record['run'])
+            record['runs'] += 1
+            record['timeouts'] += int(timed_out)
+
+    # students we haven't seen before are assumed to be average
+    def expected_duration(self, pawprint, default=0.0):
+        record = self.records.get(pawprint)
+        if record is None:
+            return default
+        return record['compile'] + record['run']
+
+    def mean_duration(self):
+        if not self.records:
+            return 0.0
+        return sum(record['compile'] + record['run'] for record in self.records.values()) / len(self.records)
+
+    def is_timeout_prone(self, pawprint):
+        record = self.records.get(pawprint)
+        return record is not None and record['timeouts'] >= self.timeout_prone_ratio * record['runs']
+
+
+# Timings taken while more processes want the CPU than there are cores (other graders on the node, or a
+# valgrind_workers setting larger than the default) mostly measure the contention, so they're left out of the history
+def cpu_oversubscribed():
+    return os.getloadavg()[0] > (os.cpu_count() or 1)
+
+
+# leaves a couple of cores free so timed runs don't compete with valgrind
+def default_valgrind_workers():
+    return max(1, (os.cpu_count() or 1) - 2)
 
 
 CONFIG_FILE = "config.toml"
@@ -76,18 +231,19 @@ CONFIG_FILE = "config.toml"
 
 # help
 def function_usage_help():
-    print("Usage: python3 backup.py {lab_name} {TA name}")
+    print("Usage: python3 backup.py {lab_name} {TA name} [--watch]")
+    print("  --watch: keep running and grade each student as soon as they submit")
     exit()
 
 
 # Wrapper function for requests.get that prints for HTTP errors
-def make_api_call(url, token, headers=None):
+def make_api_call(url, token, headers=None, params=None):
     auth_header = {'Authorization': 'Bearer ' + token}
     try:
         if headers is None:
-            response = requests.get(url, headers=auth_header)
+            response = requests.get(url, headers=auth_header, params=params)
         else:
-            response = requests.get(url, headers=headers + auth_header)
+            response = requests.get(url, headers=headers + auth_header, params=params)
         if response.status_code == 200:
             return response
         else:
@@ -97,6 +253,27 @@ def make_api_call(url, token, headers=None):
     return None
 
 
+# Raised when a paginated Canvas request can't be completed, so callers never act on a partial result
+class CanvasAPIError(Exception):
+    pass
+
+
+# Yields each page of a paginated Canvas API response, following the Link headers until there are no more pages.
+# Raises CanvasAPIError if any page fails to download.
+def iterate_api_pages(url, token, params=None):
+    response = make_api_call(url, token, params=params)
+    while True:
+        if response is None:
+            raise CanvasAPIError(f"Unable to download {url} from Canvas")
+        yield response.json()
+        next_link = response.links.get('next')
+        if next_link is None:
+            return
+        # the next link already carries the query string
+        url = next_link['url']
+        response = make_api_call(url, token)
+
+
 # Get individual submission of assignment from cache and determine if the score matches the criteria
 def get_assignment_score(config_obj, user_id):
     with open(config_obj.get_complete_cache_path() + "/attendance_submissions.json", 'r', encoding='utf-8') as file:
@@ -109,23 +286,28 @@ def get_assignment_score(config_obj, user_id):
         return False
 
 
+# Checks a student's attendance for the current lab, using the bulk attendance matrix if one was loaded
+def is_student_present(context, user_id):
+    config_obj = context.config_obj
+    if context.attendance_matrix is None:
+        return get_assignment_score(config_obj, user_id)
+    score = context.attendance_matrix.get_score(context.command_args_obj.lab_name[3:], user_id)
+    return score == config_obj.attendance_assignment_point_criterion
+
+
 # Generates a roster based on the grader's group on Canvas.
 def generate_grader_roster(context):
     config_obj = context.config_obj
     command_args_obj = context.command_args_obj
     csv_rosters_path = config_obj.hellbender_lab_dir + config_obj.class_code + "/csv_rosters"
-    fieldnames = ['pawprint', 'canvas_id', 'name', 'date']
     # first we'll check if the roster already exists.
     if os.path.exists(csv_rosters_path + "/" + command_args_obj.grader_name + ".csv") and Path(
             csv_rosters_path + "/" + command_args_obj.grader_name + ".csv").stat().st_size != 0 and config_obj.roster_invalidation_days > 0:
         # if it does, let's see how old it is
         # every student has a date appended to it which should be the same so we'll just check the first one
-        with open(csv_rosters_path + "/" + command_args_obj.grader_name + ".csv", 'r', newline='') as csvfile:
-            reader = DictReader(csvfile, fieldnames=fieldnames)
-            next(reader)  # consume header
-            sample_row = next(reader)
-            stored_date_str = sample_row['date']
-            stored_date_obj = datetime.datetime.strptime(stored_date_str, "%Y-%m-%d %H:%M:%S.%f")
+        sample_entry = next(read_roster(csv_rosters_path + "/" + command_args_obj.grader_name + ".csv"), None)
+        if sample_entry is not None:
+            stored_date_obj = datetime.datetime.strptime(sample_entry.date, "%Y-%m-%d %H:%M:%S.%f")
             invalidation_date = datetime.datetime.now() - datetime.timedelta(days=config_obj.roster_invalidation_days)
             if stored_date_obj > invalidation_date:
                 print(f"{Fore.BLUE}Roster data is recent enough to be used{Style.RESET_ALL}")
@@ -150,7 +332,7 @@ def generate_grader_roster(context):
     if not os.path.exists(csv_rosters_path):
         os.makedirs(csv_rosters_path)
     with open(csv_rosters_path + "/" + command_args_obj.grader_name + ".csv", 'w', newline='') as csvfile:
-        writer = DictWriter(csvfile, fieldnames=fieldnames)
+        writer = DictWriter(csvfile, fieldnames=FIELDNAMES)
         writer.writeheader()
         data = []
         for key in users_in_group.json():
@@ -161,10 +343,13 @@ def generate_grader_roster(context):
 
 
 # Get list of assignments from Canvas and export to JSON file
+# Raises CanvasAPIError if Canvas can't be reached, leaving any previously exported file alone
 def generate_assignment_list(config_obj, command_args_obj):
     assignment_id = 0
     canvas_assignments_api = config_obj.api_prefix + "courses/" + str(config_obj.course_id) + "/assignments?per_page=50"
     response = make_api_call(canvas_assignments_api, config_obj.api_token)
+    if response is None:
+        raise CanvasAPIError("Unable to download the assignment list from Canvas")
     attendance_name = config_obj.attendance_assignment_name_scheme + command_args_obj.lab_name[3:]
     for key in response.json():
         if key['name'] == config_obj.attendance_assignment_name_scheme + command_args_obj.lab_name[3:]:
@@ -178,11 +363,92 @@ def generate_assignment_list(config_obj, command_args_obj):
     canvas_assignments_api = config_obj.api_prefix + "courses/" + str(config_obj.course_id) + "/assignments/" + str(
         assignment_id) + "/submissions?per_page=200"
     response = make_api_call(canvas_assignments_api, config_obj.api_token)
+    if response is None:
+        raise CanvasAPIError(f"Unable to download submissions for {attendance_name} from Canvas")
 
     with open(config_obj.get_complete_cache_path() + "/attendance_submissions.json", 'w', encoding='utf-8') as file:
         json.dump(response.json(), file, ensure_ascii=False, indent=4)
 
 
+# Builds a student x lab attendance matrix from every attendance assignment in the course.
+# All of the assignments' submissions come from one paginated call to Canvas's multi-assignment submissions endpoint.
+# The matrix is only saved once every page has come back. Raises CanvasAPIError otherwise.
+def generate_attendance_matrix(config_obj):
+    scheme = config_obj.attendance_assignment_name_scheme
+    course_api = config_obj.api_prefix + "courses/" + str(config_obj.course_id)
+    assignment_labs = {}
+    for page in iterate_api_pages(course_api + "/assignments", config_obj.api_token,
+                                  params={'search_term': scheme, 'per_page': 100}):
+        for key in page:
+            if key['name'].startswith(scheme):
+                assignment_labs[key['id']] = key['name'][len(scheme):]
+    if not assignment_labs:
+        return None
+    print(f"{Fore.BLUE}Downloading attendance for {len(assignment_labs)} assignments{Style.RESET_ALL}")
+    matrix = AttendanceMatrix(assignment_labs.values(), datetime.datetime.now())
+    params = {'student_ids[]': 'all', 'assignment_ids[]': list(assignment_labs.keys()), 'per_page': 100}
+    for page in iterate_api_pages(course_api + "/students/submissions", config_obj.api_token, params=params):
+        for key in page:
+            lab = assignment_labs.get(key['assignment_id'])
+            if lab is not None:
+                matrix.set_score(lab, key['user_id'], key['score'])
+    matrix.save(config_obj.get_attendance_matrix_path())
+    return matrix
+
+
+# Re-downloads attendance for a single lab and applies it to an already loaded matrix.
+# Only used by --watch, so the matrix's date is left alone and it isn't saved.
+# Scores are only applied once every page has come back. Raises CanvasAPIError otherwise.
+def refresh_lab_attendance(config_obj, matrix, lab):
+    attendance_name = config_obj.attendance_assignment_name_scheme + lab
+    course_api = config_obj.api_prefix + "courses/" + str(config_obj.course_id)
+    assignment_id = None
+    for page in iterate_api_pages(course_api + "/assignments", config_obj.api_token,
+                                  params={'search_term': attendance_name, 'per_page': 100}):
+        for key in page:
+            if key['name'] == attendance_name:
+                assignment_id = key['id']
+    if assignment_id is None:
+        raise CanvasAPIError(f"Unable to find {attendance_name} on Canvas")
+    scores = []
+    for page in iterate_api_pages(course_api + "/assignments/" + str(assignment_id) + "/submissions",
+                                  config_obj.api_token, params={'per_page': 100}):
+        for key in page:
+            scores.append((key['user_id'], key['score']))
+    for user_id, score in scores:
+        matrix.set_score(lab, user_id, score)
+
+
+# Loads the stored attendance matrix, only going back to Canvas if it's missing, stale, or doesn't have this lab yet
+def prepare_attendance_matrix(context):
+    config_obj = context.config_obj
+    lab = context.command_args_obj.lab_name[3:]
+    matrix = None
+    if os.path.exists(config_obj.get_attendance_matrix_path()):
+        try:
+            matrix = AttendanceMatrix.load(config_obj.get_attendance_matrix_path())
+        except (ValueError, KeyError):
+            print(f"{Fore.YELLOW}(WARNING) - Stored attendance data is unreadable, downloading it again.{Style.RESET_ALL}")
+    invalidation_date = datetime.datetime.now() - datetime.timedelta(hours=config_obj.attendance_invalidation_hours)
+    if matrix is not None and matrix.has_lab(lab) and matrix.date > invalidation_date:
+        print(f"{Fore.BLUE}Attendance data is recent enough to be used{Style.RESET_ALL}")
+    else:
+        try:
+            matrix = generate_attendance_matrix(config_obj)
+        except CanvasAPIError as e:
+            print(f"{Fore.RED}(ERROR) - {e}. Attendance data would be incomplete.{Style.RESET_ALL}")
+            print(f"{Fore.RED}(ERROR) - Disabling attendance checking for this execution.{Style.RESET_ALL}")
+            config_obj.check_attendance = False
+            return
+    if matrix is None or not matrix.has_lab(lab):
+        print(
+            f"{Fore.RED}(ERROR) - Unable to find an assignment matching {config_obj.attendance_assignment_name_scheme + lab} from Canvas.{Style.RESET_ALL}")
+        print(f"{Fore.RED}(ERROR) - Disabling attendance checking for this execution.{Style.RESET_ALL}")
+        config_obj.check_attendance = False
+        return
+    context.attendance_matrix = matrix
+
+
 # Preamble function responsible for generating and prepping any necessary directories and files
 def gen_directories(context):
     config_obj = context.config_obj
@@ -236,87 +502,392 @@ def perform_backup(context, lab_path):
             if not os.path.isdir(qualified_filename):
                 shutil.copy(qualified_filename, config_obj.get_complete_cache_path())
 
-    with open(grader_csv, "r", newline="") as pawprints_list:
-        next(pawprints_list)
-        fieldnames = ['pawprint', 'canvas_id', 'name', 'date']
-        csvreader = DictReader(pawprints_list, fieldnames=fieldnames)
+    # schedule students who have been quick in past labs first so results start showing up sooner.
+    # students who keep timing out go in a slow lane that only starts once everyone else is done
+    history = context.student_history
+    default_duration = history.mean_duration()
+    entries = sorted(read_roster(grader_csv),
+                     key=lambda entry: history.expected_duration(entry.pawprint, default_duration))
+    fast_lane = [entry for entry in entries if not history.is_timeout_prone(entry.pawprint)]
+    slow_lane = [entry for entry in entries if history.is_timeout_prone(entry.pawprint)]
+    if slow_lane:
+        print(f"{Fore.BLUE}{len(slow_lane)} student(s) have timed out before and will run last{Style.RESET_ALL}")
+
+    # valgrind is the slowest stage, so it runs in the background across students while we move on to the next one
+    valgrind_jobs = []
+    with ThreadPoolExecutor(max_workers=config_obj.valgrind_workers or default_valgrind_workers()) as valgrind_executor:
         # for each name, we need to check if there's a valid submission
-        for row in csvreader:
-            # sanitize pawprint for best results
-            pawprint = row['pawprint']
-            pawprint = re.sub(r'\W+', '', pawprint)
-            pawprint = pawprint.replace("\n", "")
-            name = row['name']
-            canvas_id = row['canvas_id']
-            local_name_dir = lab_path + "/" + name
-
-            if config_obj.check_attendance:
-                if not get_assignment_score(config_obj, canvas_id):
+        # pawprints come out of the roster reader already sanitized
+        for entry in fast_lane + slow_lane:
+            valgrind_jobs += backup_student(context, lab_path, submissions_dir, entry, valgrind_executor)
+        # surface anything unexpected that happened in a worker
+        for job in valgrind_jobs:
+            job.result()
+    history.save()
+
+
+# Copies, compiles, and runs a single student's submission into their local directory.
+# If an executor is given, valgrind runs are submitted to it and their futures returned instead of running inline.
+def backup_student(context, lab_path, submissions_dir, entry, valgrind_executor=None):
+    config_obj = context.config_obj
+    valgrind_jobs = []
+    compiled = False
+    compile_seconds = 0.0
+    run_seconds = 0.0
+    timed_out = False
+    pawprint = entry.pawprint
+    name = entry.name
+    canvas_id = entry.canvas_id
+    local_name_dir = lab_path + "/" + name
+
+    if config_obj.check_attendance:
+        if not is_student_present(context, canvas_id):
+            print(
+                f"{Fore.YELLOW}(WARNING): {name} was marked absent during the lab session and therefore does not have a valid submission.{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}(WARNING): Skipping compilation!{Style.RESET_ALL}")
+            return []
+    pawprint_dir = submissions_dir + "/" + pawprint
+    if not config_obj.clear_existing_backups:
+        print(local_name_dir)
+        if os.path.exists(local_name_dir) and not os.path.exists(local_name_dir + "/output.log"):
+            print("Student " + pawprint + " already has a non-empty log, skipping")
+            return []
+        elif os.path.exists(local_name_dir):
+            print("Rebuilding student " + name + " directory")
+            shutil.rmtree(local_name_dir)
+
+    if not os.path.exists(pawprint_dir):
+        print(f"{Fore.YELLOW}(WARNING) - Student {name} does not have a valid submission.{Style.RESET_ALL}")
+        return []
+        # if there is a submission, copy it over to the local directory
+    else:
+        os.makedirs(local_name_dir)
+        for filename in os.listdir(pawprint_dir):
+            shutil.copy(pawprint_dir + "/" + filename, local_name_dir)
+
+            # grab cache results
+            for x in os.listdir(config_obj.get_complete_cache_path()):
+                try:
+                    shutil.copy(config_obj.get_complete_cache_path() + "/" + x, local_name_dir)
+
+                except PermissionError:
                     print(
-                        f"{Fore.YELLOW}(WARNING): {name} was marked absent during the lab session and therefore does not have a valid submission.{Style.RESET_ALL}")
-                    print(f"{Fore.YELLOW}(WARNING): Skipping compilation!{Style.RESET_ALL}")
-                    continue
-            pawprint_dir = submissions_dir + "/" + pawprint
-            if not config_obj.clear_existing_backups:
-                print(local_name_dir)
-                if os.path.exists(local_name_dir) and not os.path.exists(local_name_dir + "/output.log"):
-                    print("Student " + pawprint + " already has a non-empty log, skipping")
+                        f"{Fore.RED}(ERROR) - Unable to copy cached files into student {name}'s directory.{Style.RESET_ALL}")
+                    print(
+                        f"{Fore.RED}(ERROR) - This can happen if a student turned in a file that has an identical name (including the extension){Style.RESET_ALL}")
                     continue
+            # if it's a c file, let's try to compile it and write the output to a file
+            if ".c" in filename and config_obj.compile_submissions:
+                print(f"{Fore.BLUE}Compiling student {name}'s lab{Style.RESET_ALL}")
+                start_time = time.monotonic()
+                if config_obj.use_makefile:
+                    run(["make"], stdout=DEVNULL, cwd=local_name_dir)
                 else:
-                    print("Rebuilding student " + name + " directory")
-                    shutil.rmtree(local_name_dir)
+                    compilable_lab = local_name_dir + "/" + filename
+                    run(["gcc", "-Wall", "-Werror", "-o", local_name_dir + "/a.out", compilable_lab])
+                compile_seconds += time.monotonic() - start_time
+                compiled = True
+                if config_obj.execute_submissions:
+                    start_time = time.monotonic()
+                    try:
+                        print(f"{Fore.BLUE}Executing student {name}'s lab{Style.RESET_ALL}")
+                        executable_path = Path(local_name_dir) / "a.out"
+                        output_log_path = Path(local_name_dir) / "output.log"
 
-            if not os.path.exists(pawprint_dir):
-                print(f"{Fore.YELLOW}(WARNING) - Student {name} does not have a valid submission.{Style.RESET_ALL}")
+                        result = run_submission(["stdbuf", "-oL", executable_path], config_obj.execution_timeout,
+                                                config_obj.output_stall_timeout, config_obj.input_string or None)
+                        run_seconds += time.monotonic() - start_time
+                        with output_log_path.open('w') as log:
+                            log.write(result.stdout)
+                        if config_obj.generate_valgrind_output:
+                            if valgrind_executor is None:
+                                valgrind_student(config_obj, name, local_name_dir)
+                            else:
+                                valgrind_jobs.append(
+                                    valgrind_executor.submit(valgrind_student, config_obj, name, local_name_dir))
+                    except TimeoutExpired:
+                        run_seconds += time.monotonic() - start_time
+                        timed_out = True
+                        print(f"{Fore.YELLOW}(WARNING) - Student {name}'s lab took too long.{Style.RESET_ALL}")
+                    except FileNotFoundError:
+                        print(
+                            f"{Fore.YELLOW}(ERROR) - Student {name}'s lab didn't produce an executable. Double check that their submission is correct.{Style.RESET_ALL}")
+    # one record per student per lab, however many files they turned in
+    if compiled and context.student_history is not None:
+        if cpu_oversubscribed():
+            print(f"{Fore.YELLOW}(WARNING) - The machine is overloaded, not recording {name}'s timings.{Style.RESET_ALL}")
+        else:
+            context.student_history.record(pawprint, compile_seconds, run_seconds, timed_out)
+    return valgrind_jobs
+
+
+# Runs a student's program, giving up after timeout seconds.
+# If stall_timeout is set, the program is also cut short once it goes that long without printing anything,
+# which catches most infinite loops well before the full timeout. Either way TimeoutExpired is raised.
+def run_submission(args, timeout, stall_timeout, input_string):
+    if not stall_timeout:
+        return run(args, timeout=timeout, stdout=PIPE, stderr=PIPE, universal_newlines=True, input=input_string)
+    process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+    # input is fed in the same loop that reads output (like communicate() does), so a program that doesn't read
+    # its input, or fills its output pipe before reading it all, can't hang us past the deadline
+    pending_input = memoryview((input_string or "").encode())
+    output = bytearray()
+    deadline = time.monotonic() + timeout
+    last_output = time.monotonic()
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ)
+        if pending_input:
+            selector.register(process.stdin, selectors.EVENT_WRITE)
+        else:
+            process.stdin.close()
+        while selector.get_map():
+            wait = min(deadline, last_output + stall_timeout) - time.monotonic()
+            if wait <= 0:
+                kill_submission(process)
+                raise TimeoutExpired(args, timeout, output=bytes(output))
+            for key, _ in selector.select(timeout=wait):
+                if key.fileobj is process.stdin:
+                    try:
+                        # a pipe that selects as writable always has room for this much
+                        pending_input = pending_input[os.write(process.stdin.fileno(), pending_input[:512]):]
+                    except BrokenPipeError:
+                        # the program exited or closed its input without reading all of it
+                        pending_input = pending_input[:0]
+                    if not pending_input:
+                        selector.unregister(process.stdin)
+                        try:
+                            process.stdin.close()
+                        except BrokenPipeError:
+                            pass
+                else:
+                    chunk = os.read(process.stdout.fileno(), 4096)
+                    if not chunk:
+                        selector.unregister(process.stdout)
+                        continue
+                    output += chunk
+                    last_output = time.monotonic()
+    process.stdout.close()
+    # the program may have closed its output but still be running
+    try:
+        returncode = process.wait(timeout=max(deadline - time.monotonic(), 0))
+    except TimeoutExpired:
+        kill_submission(process)
+        raise TimeoutExpired(args, timeout, output=bytes(output))
+    return CompletedProcess(args, returncode, output.decode(errors='replace'), "")
+
+
+def kill_submission(process):
+    process.kill()
+    process.wait()
+    for pipe in (process.stdin, process.stdout):
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+# Runs a student's executable under valgrind, writing a readable report of the parsed results next to the raw XML
+def valgrind_student(config_obj, name, local_name_dir):
+    executable_path = Path(local_name_dir) / "a.out"
+    valgrind_log_path = Path(local_name_dir) / "valgrind.log"
+    valgrind_xml_path = Path(local_name_dir) / "valgrind.xml"
+    try:
+        report = run_valgrind(executable_path, valgrind_xml_path, timeout=config_obj.execution_timeout,
+                              input_string=config_obj.input_string or None, cwd=local_name_dir)
+    except TimeoutExpired:
+        print(f"{Fore.YELLOW}(WARNING) - Student {name}'s lab took too long under valgrind.{Style.RESET_ALL}")
+        return
+    except FileNotFoundError:
+        print(f"{Fore.YELLOW}(ERROR) - Unable to run valgrind on student {name}'s lab.{Style.RESET_ALL}")
+        return
+    with valgrind_log_path.open('w') as vg_log:
+        vg_log.write(report.render())
+    if not report.complete:
+        print(f"{Fore.YELLOW}(WARNING) - Valgrind output for student {name} is incomplete, check {valgrind_log_path}. Found so far: {report.summary()}{Style.RESET_ALL}")
+    elif report.has_errors or report.has_leaks:
+        print(f"{Fore.YELLOW}Valgrind for student {name}: {report.summary()}{Style.RESET_ALL}")
+    else:
+        print(f"{Fore.BLUE}Valgrind for student {name}: no errors or leaks{Style.RESET_ALL}")
+
+
+# Adds the given students' submissions to the index under the lock, and returns the updated index
+def index_submissions(index_path, lab_path, names, cached_files, boilerplate_sources, grader_name):
+    with locked(index_path):
+        index = SimilarityIndex.load(index_path)
+        boilerplate = index.fingerprint_sources(boilerplate_sources)
+        for name in names:
+            student_dir = lab_path + "/" + name
+            if not os.path.isdir(student_dir):
+                continue
+            sources = []
+            for filename in sorted(os.listdir(student_dir)):
+                if filename.endswith(".c") and filename not in cached_files:
+                    with open(student_dir + "/" + filename, 'r', errors='replace') as file:
+                        sources.append(file.read())
+            index.add(grader_name + "/" + name, sources, boilerplate)
+        index.save()
+    return index
+
+
+# Adds backed up submissions to the lab's shared similarity index and reports likely copies.
+# Only the given students are re-indexed if names is passed, otherwise everyone in the backup folder is.
+# Files from the lab's cache (test files, headers, etc) are left out, and code they contain is treated as boilerplate.
+def update_similarity_index(context, lab_path, names=None):
+    config_obj = context.config_obj
+    command_args_obj = context.command_args_obj
+    index_path = config_obj.get_similarity_index_path(command_args_obj.lab_name)
+    cache_path = config_obj.get_complete_cache_path()
+    cached_files = set(os.listdir(cache_path))
+    if names is None:
+        names = [name for name in os.listdir(lab_path) if os.path.isdir(lab_path + "/" + name)]
+
+    boilerplate_sources = []
+    for filename in cached_files:
+        if filename.endswith((".c", ".h")):
+            with open(cache_path + "/" + filename, 'r', errors='replace') as file:
+                boilerplate_sources.append(file.read())
+
+    print(f"{Fore.BLUE}Updating similarity index for {command_args_obj.lab_name}{Style.RESET_ALL}")
+    try:
+        index = index_submissions(index_path, lab_path, names, cached_files, boilerplate_sources,
+                                  command_args_obj.grader_name)
+    except (OSError, ValueError) as e:
+        # the backup itself is done at this point, so don't throw it away over the index.
+        # nothing has been saved, so whatever is in the index stays as it was
+        print(f"{Fore.RED}(ERROR) - Unable to update the similarity index at {index_path}: {e}{Style.RESET_ALL}")
+        return
+
+    # report everything that involves this grader's students, wherever the other half of the pair is
+    own_keys = {key for key in index.documents if key.startswith(command_args_obj.grader_name + "/")}
+    pairs = index.similar_pairs(config_obj.similarity_threshold, own_keys)
+    with open(lab_path + "/similarity_report.txt", 'w') as report:
+        for first, second, similarity in pairs:
+            report.write(f"{similarity:.0%}\t{first}\t{second}\n")
+    if pairs:
+        print(f"{Fore.YELLOW}(WARNING) - {len(pairs)} pair(s) of submissions look similar, see {lab_path}/similarity_report.txt{Style.RESET_ALL}")
+    else:
+        print(f"{Fore.BLUE}No similar submissions found{Style.RESET_ALL}")
+
+
+# Maps each student's pawprint to the .valid directory their submission symlink currently points at
+def snapshot_submission_links(submissions_dir):
+    links = {}
+    if not os.path.isdir(submissions_dir):
+        return links
+    for entry in os.scandir(submissions_dir):
+        if entry.is_symlink():
+            try:
+                links[entry.name] = os.readlink(entry.path)
+            except OSError:
                 continue
-                # if there is a submission, copy it over to the local directory
+    return links
+
+
+# Downloads attendance again so students marked present since the last download are picked up
+# A failed download keeps the attendance data we already have, so a dropped request can't end --watch.
+def refresh_attendance(context):
+    config_obj = context.config_obj
+    try:
+        if context.attendance_matrix is not None:
+            refresh_lab_attendance(config_obj, context.attendance_matrix, context.command_args_obj.lab_name[3:])
+        else:
+            generate_assignment_list(config_obj, context.command_args_obj)
+    # ValueError covers a response that isn't valid JSON
+    except (CanvasAPIError, ValueError) as e:
+        print(f"{Fore.YELLOW}(WARNING) - {e}. Keeping the attendance data we already have.{Style.RESET_ALL}")
+
+
+# Long-running mode that grades each student as soon as MUCSMake places a new valid submission.
+# MUCSMake fills in .valid/<user>_<date> first and creates or repoints the user's symlink last,
+# so a new or changed symlink means the submission is ready to be backed up.
+def watch_submissions(context, lab_path):
+    config_obj = context.config_obj
+    command_args_obj = context.command_args_obj
+    grader_csv = config_obj.get_complete_hellbender_path() + "/csv_rosters/" + command_args_obj.grader_name + ".csv"
+    submissions_dir = config_obj.get_complete_hellbender_path() + "/submissions/" + command_args_obj.lab_name + "/" + command_args_obj.grader_name
+
+    # take the snapshot before the initial pass so anything submitted during it gets picked up afterwards
+    known_links = snapshot_submission_links(submissions_dir)
+    perform_backup(context, lab_path)
+    if config_obj.build_similarity_index:
+        update_similarity_index(context, lab_path)
+
+    # attendance is usually entered while the lab is still going, so students who submitted before being marked
+    # present wait here and are rechecked whenever attendance is downloaded again, instead of being skipped for good
+    awaiting_attendance = {}
+    if config_obj.check_attendance:
+        for pawprint in known_links:
+            entry = load_roster_columns(grader_csv).lookup(pawprint)
+            if entry is not None and not is_student_present(context, entry.canvas_id):
+                awaiting_attendance[pawprint] = entry
+        if awaiting_attendance:
+            print(f"{Fore.BLUE}{len(awaiting_attendance)} student(s) will be backed up once they're marked present{Style.RESET_ALL}")
+    last_attendance_refresh = time.monotonic()
+
+    inotify = None
+    watch_descriptor = None
+    if INotify is not None:
+        inotify = INotify()
+    else:
+        print(f"{Fore.YELLOW}(WARNING) - inotify_simple is not installed, polling every {config_obj.watch_poll_interval} seconds instead.{Style.RESET_ALL}")
+    print(f"{Fore.BLUE}Watching {submissions_dir} for new submissions. Press Ctrl+C to stop.{Style.RESET_ALL}")
+    try:
+        while True:
+            # the grader's folder doesn't exist until the first submission is placed
+            if inotify is not None and watch_descriptor is None and os.path.isdir(submissions_dir):
+                watch_descriptor = inotify.add_watch(submissions_dir, flags.CREATE | flags.DELETE | flags.MOVED_TO)
+            if watch_descriptor is not None:
+                # still wake up periodically, inotify won't see changes made from other cluster nodes
+                inotify.read(timeout=config_obj.watch_poll_interval * 1000)
             else:
-                os.makedirs(local_name_dir)
-                for filename in os.listdir(pawprint_dir):
-                    shutil.copy(pawprint_dir + "/" + filename, local_name_dir)
+                time.sleep(config_obj.watch_poll_interval)
 
-                    # grab cache results
-                    for x in os.listdir(config_obj.get_complete_cache_path()):
-                        try:
-                            shutil.copy(config_obj.get_complete_cache_path() + "/" + x, local_name_dir)
-
-                        except PermissionError:
-                            print(
-                                f"{Fore.RED}(ERROR) - Unable to copy cached files into student {name}'s directory.{Style.RESET_ALL}")
-                            print(
-                                f"{Fore.RED}(ERROR) - This can happen if a student turned in a file that has an identical name (including the extension){Style.RESET_ALL}")
-                            continue
-                    # if it's a c file, let's try to compile it and write the output to a file
-                    if ".c" in filename and config_obj.compile_submissions:
-                        print(f"{Fore.BLUE}Compiling student {name}'s lab{Style.RESET_ALL}")
-                        if config_obj.use_makefile:
-                            run(["make"], stdout=DEVNULL, cwd=local_name_dir)
-                        else:
-                            compilable_lab = local_name_dir + "/" + filename
-                            run(["gcc", "-Wall", "-Werror", "-o", local_name_dir + "/a.out", compilable_lab])
-                        if config_obj.execute_submissions:
-                            try:
-                                print(f"{Fore.BLUE}Executing student {name}'s lab{Style.RESET_ALL}")
-                                executable_path = Path(local_name_dir) / "a.out"
-                                output_log_path = Path(local_name_dir) / "output.log"
-
-                                result = run(["stdbuf", "-oL", executable_path], timeout=config_obj.execution_timeout,
-                                             stdout=PIPE, stderr=PIPE, universal_newlines=True,
-                                             input=config_obj.input_string or None)
-                                with output_log_path.open('w') as log:
-                                    log.write(result.stdout)
-                                if config_obj.generate_valgrind_output:
-                                    valgrind_log_path = Path(local_name_dir) / "valgrind.log"
-                                    result = run(["valgrind", executable_path], timeout=config_obj.execution_timeout,
-                                                 stdout=PIPE, stderr=PIPE, universal_newlines=True,
-                                                 input=config_obj.input_string or None)
-                                    with valgrind_log_path.open('w') as vg_log:
-                                        vg_log.write(result.stderr)
-                            except TimeoutExpired:
-                                print(f"{Fore.YELLOW}(WARNING) - Student {name}'s lab took too long.{Style.RESET_ALL}")
-                            except FileNotFoundError:
-                                print(
-                                    f"{Fore.YELLOW}(ERROR) - Student {name}'s lab didn't produce an executable. Double check that their submission is correct.{Style.RESET_ALL}")
+            current_links = snapshot_submission_links(submissions_dir)
+            ready = []
+            for pawprint, target in current_links.items():
+                if known_links.get(pawprint) == target:
+                    continue
+                entry = load_roster_columns(grader_csv).lookup(pawprint)
+                if entry is None:
+                    print(f"{Fore.YELLOW}(WARNING) - {pawprint} submitted but is not on {command_args_obj.grader_name}'s roster.{Style.RESET_ALL}")
+                    continue
+                print(f"{Fore.BLUE}New submission from {entry.name}{Style.RESET_ALL}")
+                ready.append(entry)
+            known_links = current_links
+
+            if config_obj.check_attendance and (ready or awaiting_attendance):
+                # students who really were absent stay in the waiting list all session, so Canvas is only
+                # asked again every few minutes rather than on every poll
+                if time.monotonic() - last_attendance_refresh >= config_obj.attendance_refresh_minutes * 60:
+                    refresh_attendance(context)
+                    last_attendance_refresh = time.monotonic()
+                # everyone still waiting is rechecked alongside the new submissions
+                candidates = dict(awaiting_attendance)
+                candidates.update({entry.pawprint: entry for entry in ready})
+                ready = []
+                for pawprint, entry in candidates.items():
+                    # refreshing can turn attendance checking off if the assignment disappeared from Canvas
+                    if not config_obj.check_attendance or is_student_present(context, entry.canvas_id):
+                        awaiting_attendance.pop(pawprint, None)
+                        ready.append(entry)
+                    elif pawprint not in awaiting_attendance:
+                        print(f"{Fore.YELLOW}(WARNING): {entry.name} hasn't been marked present yet, they'll be backed up once they are.{Style.RESET_ALL}")
+                        awaiting_attendance[pawprint] = entry
+
+            for entry in ready:
+                # a resubmission replaces whatever we backed up for them earlier
+                local_name_dir = lab_path + "/" + entry.name
+                if os.path.exists(local_name_dir):
+                    shutil.rmtree(local_name_dir)
+                backup_student(context, lab_path, submissions_dir, entry)
+                context.student_history.save()
+                if config_obj.build_similarity_index:
+                    update_similarity_index(context, lab_path, [entry.name])
+    except KeyboardInterrupt:
+        print(f"{Fore.BLUE}Stopped watching for submissions{Style.RESET_ALL}")
+    finally:
+        if inotify is not None:
+            inotify.close()
 
 
 def prepare_toml_doc():
@@ -350,14 +921,30 @@ def prepare_toml_doc():
     general.add("execute_submissions", True)
     general.add(comment(" Whether or not the script should also generate a valgrind output of the submission."))
     general.add(comment(" You need to have previously enabled submission execution for this to work."))
-    general.add(comment(" Whether or not the script should clear existing lab backups."))
     general.add("generate_valgrind_output", True)
+    general.add(comment(" Whether or not the script should clear existing lab backups."))
     general.add("clear_existing_backups", True)
     general.add(comment(
         " If you're executing submissions, this string will be inserted into stdio during execution. Leave blank to not insert anything."))
     general.add("input_string", "")
     general.add(comment(" Whether or not to check Canvas for attendance points."))
     general.add("check_attendance", False)
+    general.add(comment(" When running with --watch, how often (in seconds) to check for new submissions."))
+    general.add(comment(" inotify is used to react sooner when the inotify_simple package is installed."))
+    general.add("watch_poll_interval", 5)
+    general.add(comment(" When running with --watch, how often (in minutes) to download attendance again for students"))
+    general.add(comment(" who submitted before being marked present."))
+    general.add("attendance_refresh_minutes", 5)
+    general.add(comment(" How many valgrind runs to do at once. 0 uses every core but two, which are left for timed runs."))
+    general.add("valgrind_workers", 0)
+    general.add(comment(" Stop a running submission early if it goes this many seconds without printing anything."))
+    general.add(comment(" Set to 0 to only use execution_timeout."))
+    general.add("output_stall_timeout", 0)
+    general.add(comment(" Whether or not to add backed up submissions to the lab's similarity index and report likely copies."))
+    general.add(comment(" The index is shared by every grader and kept in similarity_index_dir under [paths]."))
+    general.add("build_similarity_index", False)
+    general.add(comment(" How similar (0 to 1) two submissions need to be to get reported."))
+    general.add("similarity_threshold", 0.6)
     doc["general"] = general
 
     # [paths] section
@@ -371,6 +958,10 @@ def prepare_toml_doc():
     paths.add("hellbender_lab_dir", "/cluster/pixstor/class/")
     paths.add(comment(" created in the local storage dir"))
     paths.add("cache_dir", "cache")
+    paths.add(comment(" where the shared similarity index is kept, the class code will be appended to it like hellbender_lab_dir"))
+    paths.add(comment(" this needs to be somewhere only graders can write, NOT the class directory, since students can write"))
+    paths.add(comment(" to the submission folders there. Required for build_similarity_index."))
+    paths.add("similarity_index_dir", "")
     doc["paths"] = paths
 
     # [canvas] section
@@ -392,6 +983,10 @@ def prepare_toml_doc():
     canvas.add(
         comment(" How many points a student should have in the attendance assignment to qualify for compilation. "))
     canvas.add("attendance_assignment_point_criterion", 1.0)
+    canvas.add(comment(" Download attendance for every lab at once and keep it locally, instead of once per run."))
+    canvas.add("bulk_attendance", False)
+    canvas.add(comment(" When using bulk attendance, how many hours the stored attendance data is trusted before downloading it again."))
+    canvas.add("attendance_invalidation_hours", 12)
     doc["canvas"] = canvas
 
     with open(CONFIG_FILE, 'w') as f:
@@ -421,19 +1016,28 @@ def load_config():
         clear_existing_backups=general.get('clear_existing_backups', True),
         input_string=general.get("input_string", ""),
         check_attendance=general.get("check_attendance", False),
+        watch_poll_interval=general.get("watch_poll_interval", 5),
+        attendance_refresh_minutes=general.get("attendance_refresh_minutes", 5),
+        valgrind_workers=general.get("valgrind_workers", 0),
+        output_stall_timeout=general.get("output_stall_timeout", 0),
+        build_similarity_index=general.get("build_similarity_index", False),
+        similarity_threshold=general.get("similarity_threshold", 0.6),
         local_storage_dir=paths.get('local_storage_dir', ""),
         hellbender_lab_dir=paths.get('hellbender_lab_dir', ""),
         cache_dir=paths.get('cache_dir', "cache"),
+        similarity_index_dir=paths.get('similarity_index_dir', ""),
         api_prefix=canvas.get('api_prefix', ""),
         api_token=canvas.get('api_token', ""),
         course_id=canvas.get('course_id', -1),
         attendance_assignment_name_scheme=canvas.get('attendance_assignment_name_scheme', ""),
-        attendance_assignment_point_criterion=canvas.get("attendance_assignment_point_criterion", 1)
+        attendance_assignment_point_criterion=canvas.get("attendance_assignment_point_criterion", 1),
+        bulk_attendance=canvas.get("bulk_attendance", False),
+        attendance_invalidation_hours=canvas.get("attendance_invalidation_hours", 12)
     )
     return config_obj
 
 
-def main(lab_name, grader):
+def main(lab_name, grader, watch=False):
     if not os.path.exists(CONFIG_FILE):
         print(f"{CONFIG_FILE} does not exist, creating a default one")
         prepare_toml_doc()
@@ -451,13 +1055,30 @@ def main(lab_name, grader):
     command_args_obj = CommandArgs(lab_name, grader)
 
     context = Context(config_obj, command_args_obj)
+    context.student_history = StudentHistory.load(config_obj.get_student_history_path())
     lab_path = gen_directories(context)
-    if config_obj.check_attendance:
-        generate_assignment_list(config_obj, command_args_obj)
-    perform_backup(context, lab_path)
+    if config_obj.build_similarity_index and not config_obj.similarity_index_dir:
+        print(f"{Fore.RED}(ERROR) - build_similarity_index needs similarity_index_dir to be set under [paths].{Style.RESET_ALL}")
+        print(f"{Fore.RED}(ERROR) - Disabling the similarity index for this execution.{Style.RESET_ALL}")
+        config_obj.build_similarity_index = False
+    if config_obj.check_attendance and config_obj.bulk_attendance:
+        prepare_attendance_matrix(context)
+    elif config_obj.check_attendance:
+        try:
+            generate_assignment_list(config_obj, command_args_obj)
+        except CanvasAPIError as e:
+            print(f"{Fore.RED}(ERROR) - {e}.{Style.RESET_ALL}")
+            print(f"{Fore.RED}(ERROR) - Disabling attendance checking for this execution.{Style.RESET_ALL}")
+            config_obj.check_attendance = False
+    if watch:
+        watch_submissions(context, lab_path)
+    else:
+        perform_backup(context, lab_path)
+        if config_obj.build_similarity_index:
+            update_similarity_index(context, lab_path)
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
         function_usage_help()
-    main(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    main(sys.argv[1], sys.argv[2], "--watch" in sys.argv[3:])
\ No newline at end of file
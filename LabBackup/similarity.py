@@ -0,0 +1,211 @@
+# Similarity index for backed up submissions
+# Fingerprints each submission with winnowed k-gram hashes and finds near-duplicates across sections
+# using MinHash signatures bucketed with LSH, so submissions are only compared against likely matches.
+
+import fcntl
+import hashlib
+import json
+import os
+import random
+import re
+import zlib
+from contextlib import contextmanager
+from itertools import combinations
+
+_token_pattern = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<preprocessor>^[ \t]*\#[^\n]*)
+    |(?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')
+    |(?P<number>\b\d[\w.]*)
+    |(?P<word>\b[A-Za-z_]\w*\b)
+    |(?P<operator>->|\+\+|--|<<=|>>=|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^!~<>=]=?|[{}()\[\];,.?:])
+    """, re.VERBOSE | re.DOTALL | re.MULTILINE)
+
+_keywords = frozenset("""
+    auto break case char const continue default do double else enum extern float for goto if inline int long
+    register restrict return short signed sizeof static struct switch typedef union unsigned void volatile while
+    bool true false NULL
+    """.split())
+
+# MinHash uses hash functions of the form (a * x + b) mod a large prime
+_prime = (1 << 61) - 1
+_permutation_seed = 1050
+
+
+# Breaks C source into tokens. Identifiers, numbers and strings are normalized so renaming variables
+# or changing literals doesn't hide a copy. Comments and preprocessor lines are dropped.
+def tokenize(source: str) -> list[str]:
+    tokens = []
+    for match in _token_pattern.finditer(source):
+        kind = match.lastgroup
+        if kind == 'comment' or kind == 'preprocessor':
+            continue
+        text = match.group()
+        if kind == 'word':
+            tokens.append(text if text in _keywords else "I")
+        elif kind == 'number':
+            tokens.append("N")
+        elif kind == 'string':
+            tokens.append("S")
+        else:
+            tokens.append(text)
+    return tokens
+
+
+# Winnowing: hash every k-gram of tokens, then keep the smallest hash in each window of consecutive hashes
+def fingerprint(tokens: list[str], k: int = 5, window: int = 4) -> set[int]:
+    hashes = [zlib.crc32(" ".join(tokens[i:i + k]).encode()) for i in range(len(tokens) - k + 1)]
+    if len(hashes) <= window:
+        return set(hashes)
+    return {min(hashes[i:i + window]) for i in range(len(hashes) - window + 1)}
+
+
+def jaccard(first: set[int], second: set[int]) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+# Every grader runs as their own user, so anything created for the shared index needs group access.
+# The umask would otherwise strip it. Only the owner can change the mode, so other graders skip this.
+def _share_with_group(path: str, mode: int):
+    try:
+        os.chmod(path, mode)
+    except PermissionError:
+        pass
+
+
+# Holds an exclusive lock on the index while it's read, updated, and written back,
+# since several graders may be updating the same lab's index at once
+@contextmanager
+def locked(index_path: str):
+    index_dir = os.path.dirname(index_path) or "."
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        # setgid so everything created inside keeps the directory's group, which should be the graders'
+        _share_with_group(index_dir, 0o2770)
+    lock_fd = os.open(index_path + ".lock", os.O_CREAT | os.O_RDWR, 0o660)
+    try:
+        _share_with_group(index_path + ".lock", 0o660)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    finally:
+        os.close(lock_fd)
+
+
+class SimilarityIndex:
+    """
+    Per-lab index of submission fingerprints, keyed by "<grader>/<student>".
+    Each document keeps its fingerprint set and MinHash signature. The signature is split into bands,
+    and only documents sharing at least one identical band are compared.
+    """
+
+    def __init__(self, path: str, bands: int = 16, rows: int = 4, k: int = 5, window: int = 4):
+        self.path = path
+        self.bands = bands
+        self.rows = rows
+        self.k = k
+        self.window = window
+        self.documents: dict[str, dict] = {}
+        self._buckets: dict[tuple, set[str]] = {}
+        rng = random.Random(_permutation_seed)
+        self._permutations = [(rng.randrange(1, _prime), rng.randrange(0, _prime)) for _ in range(bands * rows)]
+
+    # Only a missing file starts a new index. Anything else is raised (ValueError for a malformed index),
+    # since saving an empty index over one we couldn't read would wipe every other grader's entries.
+    @classmethod
+    def load(cls, path: str) -> "SimilarityIndex":
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return cls(path)
+        try:
+            index = cls(path, data['bands'], data['rows'], data['k'], data['window'])
+            for key, document in data['documents'].items():
+                document['fingerprints'] = set(document['fingerprints'])
+                index.documents[key] = document
+                index._add_to_buckets(key, document['signature'])
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"malformed similarity index: {e!r}") from e
+        return index
+
+    def save(self):
+        documents = {key: {'hash': document['hash'], 'fingerprints': sorted(document['fingerprints']),
+                           'signature': document['signature']} for key, document in self.documents.items()}
+        # written under a per-process name and renamed over the index, so a leftover temp file from another
+        # grader never gets in the way
+        temp_path = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'bands': self.bands, 'rows': self.rows, 'k': self.k, 'window': self.window,
+                       'documents': documents}, file)
+        _share_with_group(temp_path, 0o660)
+        os.replace(temp_path, self.path)
+
+    def fingerprint_sources(self, sources: list[str]) -> set[int]:
+        fingerprints = set()
+        for source in sources:
+            fingerprints |= fingerprint(tokenize(source), self.k, self.window)
+        return fingerprints
+
+    def _signature(self, fingerprints: set[int]) -> list[int]:
+        if not fingerprints:
+            return [_prime] * len(self._permutations)
+        return [min((a * x + b) % _prime for x in fingerprints) for a, b in self._permutations]
+
+    def _band_keys(self, signature: list[int]):
+        for band in range(self.bands):
+            yield (band, *signature[band * self.rows:(band + 1) * self.rows])
+
+    def _add_to_buckets(self, key: str, signature: list[int]):
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, set()).add(key)
+
+    def remove(self, key: str):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        for band_key in self._band_keys(document['signature']):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    # Adds or replaces a submission. Fingerprints that also show up in the lab's own files (boilerplate)
+    # are ignored. Returns False if the submission is unchanged since it was last indexed.
+    def add(self, key: str, sources: list[str], boilerplate: set[int] = frozenset()) -> bool:
+        source_hash = hashlib.sha256("\0".join(sources).encode()).hexdigest()
+        existing = self.documents.get(key)
+        if existing is not None and existing['hash'] == source_hash:
+            return False
+        self.remove(key)
+        fingerprints = self.fingerprint_sources(sources) - boilerplate
+        # an empty submission would land in the same buckets as every other empty submission
+        if not fingerprints:
+            return True
+        signature = self._signature(fingerprints)
+        self.documents[key] = {'hash': source_hash, 'fingerprints': fingerprints, 'signature': signature}
+        self._add_to_buckets(key, signature)
+        return True
+
+    # Returns (first key, second key, similarity) for every pair at or above the threshold, most similar first.
+    # If keys is given, only pairs involving at least one of those keys are reported.
+    def similar_pairs(self, threshold: float, keys=None) -> list[tuple[str, str, float]]:
+        candidates = set()
+        for bucket in self._buckets.values():
+            if len(bucket) < 2:
+                continue
+            for first, second in combinations(sorted(bucket), 2):
+                if keys is None or first in keys or second in keys:
+                    candidates.add((first, second))
+        pairs = []
+        for first, second in candidates:
+            similarity = jaccard(self.documents[first]['fingerprints'], self.documents[second]['fingerprints'])
+            if similarity >= threshold:
+                pairs.append((first, second, similarity))
+        pairs.sort(key=lambda pair: pair[2], reverse=True)
+        return pairs
@@ -5,6 +5,8 @@
 # Spring 2025
 
 import getpass
+import hashlib
+import json
 import sys
 import os 
 import re
@@ -25,14 +27,20 @@ from tomlkit import document, table, comment, dumps
 from csv import DictReader
 from subprocess import DEVNULL, PIPE, run
 
+# the roster module is shared with LabBackup and lives alongside both tools
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "Shared"))
+from roster import read_roster
+from valgrind import run_valgrind
+
 
 class Config:
     def __init__(self,class_code: str, run_valgrind: str, base_path: str, 
     lab_window_path: str, lab_submission_directory: str, 
     test_files_directory: str, roster_directory: str,
-    valid_dir: str, invalid_dir: str):
+    valid_dir: str, invalid_dir: str, use_result_cache: bool, result_cache_directory: str):
         self.class_code = class_code
         self.run_valgrind = run_valgrind
+        self.use_result_cache = use_result_cache
         self.base_path = base_path
         self.lab_window_path = base_path + class_code + lab_window_path
         self.lab_submission_directory = base_path + class_code + lab_submission_directory
@@ -40,6 +48,7 @@ class Config:
         self.test_files_directory = base_path + class_code + test_files_directory
         self.valid_dir = valid_dir
         self.invalid_dir = invalid_dir
+        self.result_cache_directory = os.path.expanduser(result_cache_directory)
 
 
 
@@ -47,6 +56,19 @@ class Config:
         return self.base_path + self.class_code
 
 
+# Verdicts from compiling and running a submission. Kept around so repeat submissions can be replayed from cache.
+class RunResult:
+    def __init__(self, compiled: bool, compile_output: str = "", program_output: str = "", segfault: bool = False,
+    valgrind_errors: bool = False, valgrind_leak: bool = False, valgrind_incomplete: bool = False):
+        self.compiled = compiled
+        self.compile_output = compile_output
+        self.program_output = program_output
+        self.segfault = segfault
+        self.valgrind_errors = valgrind_errors
+        self.valgrind_leak = valgrind_leak
+        self.valgrind_incomplete = valgrind_incomplete
+
+
 
 
 CONFIG_FILE = "config.toml"
@@ -82,14 +104,28 @@ def main(username: str, class_code: str, lab_name: str, file_name: str):
         print(f"{Fore.RED}*** Error: You are not enrolled in {Style.RESET_ALL}{Fore.BLUE}{config_obj.class_code}{Style.RESET_ALL}{Fore.RED} ")
     grader = determine_section(config_obj, username)
     
-    student_temp_dir = prepare_test_directory(config_obj, file_name, lab_name, username)
     # Stage 3 - Compile and Run
-    run_result = compile_and_run_submission(config_obj, student_temp_dir)
+    # if this exact submission was already tested against the current lab files, reuse the run and valgrind results.
+    # the cache lives somewhere the student can write, so it is never trusted for whether the submission compiles:
+    # that is always checked for real, and a cached result that disagrees is thrown out.
+    submission_hash = hash_submission(config_obj, file_name, lab_name)
+    cached_result = load_cached_run_result(config_obj, username, lab_name, submission_hash)
+    student_temp_dir = prepare_test_directory(config_obj, file_name, lab_name, username)
+    run_result = compile_submission(student_temp_dir)
+    if cached_result is not None and cached_result.compiled == run_result.compiled:
+        print(f"{Fore.BLUE}*** This submission is unchanged since your last attempt. Showing previous results. ***{Style.RESET_ALL}")
+        cached_result.compile_output = run_result.compile_output
+        run_result = cached_result
+    elif run_result.compiled:
+        run_compiled_submission(config_obj, student_temp_dir, run_result)
     clean_up_test_directory(student_temp_dir)
+    print_run_result(run_result)
+    if run_result is not cached_result:
+        store_cached_run_result(config_obj, username, lab_name, submission_hash, run_result)
     # Stage 4 - Place Submission
-    place_submission(config_obj, lab_window_status, run_result, grader, lab_name, file_name, username)
+    place_submission(config_obj, lab_window_status, run_result.compiled, grader, lab_name, file_name, username)
     # Stage 5 - Display Results
-    display_results(config_obj, lab_window_status, run_result, grader, lab_name, file_name, username)
+    display_results(config_obj, lab_window_status, run_result.compiled, grader, lab_name, file_name, username)
 
 
 
@@ -217,13 +253,9 @@ def verify_student_enrollment(config_obj: Config):
 
 def determine_section(config_obj: Config, username: str) -> str:
     for roster_filename in os.listdir(config_obj.roster_directory):
-        with open(config_obj.roster_directory + "/" + roster_filename, 'r') as csv_file:
-            _ = next(csv_file)
-            fieldnames = ['pawprint', 'canvas_id', 'name', 'date']
-            csv_roster = DictReader(csv_file, fieldnames=fieldnames)
-            for row in csv_roster:
-                if username == row['pawprint']:
-                    return roster_filename.replace(".csv", '')
+        for entry in read_roster(config_obj.roster_directory + "/" + roster_filename):
+            if username == entry.pawprint:
+                return roster_filename.replace(".csv", '')
     # if we made it out of the loop... panic!
     # likely a misconfiguration of the grading roster
     handle_critical_error("No grader found", "determine_section")
@@ -239,7 +271,7 @@ def prepare_test_directory(config_obj: Config, file_name: str, lab_name: str, us
         shutil.copy(entry.path, student_temp_files_dir)
     shutil.copy(file_name, student_temp_files_dir)
     return student_temp_files_dir
-def compile_and_run_submission(config_obj: Config, temp_dir: str) -> bool:
+def compile_submission(temp_dir: str) -> RunResult:
     is_make = False
     for entry in os.scandir(temp_dir):
         if (entry.name == "Makefile"):
@@ -249,31 +281,90 @@ def compile_and_run_submission(config_obj: Config, temp_dir: str) -> bool:
     if (is_make):
         result = run(["make"], cwd=temp_dir, stdout=DEVNULL, stderr=PIPE, universal_newlines=True)
     else:
-        result = run(["compile"], cwd=temp_dir)
+        result = run(["compile"], cwd=temp_dir, stderr=PIPE, universal_newlines=True)
+    # warnings are kept even when it compiles so they show up again on a cached replay
+    compile_output = result.stderr
     # returns 2 if doesnt link
-    if (result.returncode != 0):
-        print(result.stderr)
-        print(f"{Back.RED}*** Error: Submitted program does not compile! ***{Style.RESET_ALL}")
-        return False
+    return RunResult(compiled=result.returncode == 0, compile_output=compile_output)
+# Runs a submission that has already compiled, filling in the rest of its RunResult
+def run_compiled_submission(config_obj: Config, temp_dir: str, run_result: RunResult):
     executable_path = temp_dir + "/a.out"
     result = run(["stdbuf", "-oL", executable_path], timeout=5, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    print(result.stdout)
+    run_result.program_output = result.stdout
     # we got an error
     if (result.returncode < 0):
         signum = -result.returncode
         if (signum == signal.SIGSEGV):
-            print(f"{Fore.RED}Segmentation fault detected!{Style.RESET_ALL}")
+            run_result.segfault = True
     if (config_obj.run_valgrind):
-        stderr = run(["valgrind", executable_path], stdout=PIPE, stderr=PIPE, universal_newlines=True).stderr
-        if re.search(r"[1-9]\d*\s+errors", stderr):
-            print(f"{Fore.RED}Valgrind: There were errors in your program!{Style.RESET_ALL}")
-        if not re.search("(All heap blocks were freed -- no leaks are possible)", stderr):
-            print(f"{Fore.RED}Valgrind: Memory leak detected!{Style.RESET_ALL}")
-    return True
+        report = run_valgrind(executable_path, temp_dir + "/valgrind.xml", cwd=temp_dir)
+        run_result.valgrind_errors = report.has_errors
+        run_result.valgrind_leak = report.has_leaks
+        run_result.valgrind_incomplete = not report.complete
+def print_run_result(run_result: RunResult):
+    if (run_result.compile_output):
+        print(run_result.compile_output)
+    if (not run_result.compiled):
+        print(f"{Back.RED}*** Error: Submitted program does not compile! ***{Style.RESET_ALL}")
+        return
+    print(run_result.program_output)
+    if (run_result.segfault):
+        print(f"{Fore.RED}Segmentation fault detected!{Style.RESET_ALL}")
+    if (run_result.valgrind_errors):
+        print(f"{Fore.RED}Valgrind: There were errors in your program!{Style.RESET_ALL}")
+    if (run_result.valgrind_leak):
+        print(f"{Fore.RED}Valgrind: Memory leak detected!{Style.RESET_ALL}")
+    # a missing or cut off report can't be taken as a clean run
+    if (run_result.valgrind_incomplete):
+        print(f"{Fore.YELLOW}Valgrind: output was incomplete, so your program could not be fully checked for errors or leaks.{Style.RESET_ALL}")
 def clean_up_test_directory(temp_dir: str):
     shutil.rmtree(temp_dir)
 
 
+# Hashes the submission together with the lab's test files, so a change to either invalidates cached results.
+# Whether valgrind runs is folded in as well since it changes which verdicts are available.
+def hash_submission(config_obj: Config, file_name: str, lab_name: str) -> str:
+    lab_files_dir = config_obj.test_files_directory + "/" + lab_name + "_temp"
+    digest = hashlib.sha256()
+    digest.update(b"valgrind" if config_obj.run_valgrind else b"no-valgrind")
+    with open(file_name, 'rb') as submission:
+        digest.update(submission.read())
+    for entry in sorted(os.scandir(lab_files_dir), key=lambda e: e.name):
+        if entry.is_dir():
+            continue
+        digest.update(entry.name.encode())
+        with open(entry.path, 'rb') as test_file:
+            digest.update(test_file.read())
+    return digest.hexdigest()
+def get_result_cache_path(config_obj: Config, username: str, lab_name: str) -> str:
+    return config_obj.result_cache_directory + "/" + username + "_" + config_obj.class_code + "_" + lab_name + ".json"
+# Returns the previous RunResult for this user and lab if it was produced from the same submission hash
+def load_cached_run_result(config_obj: Config, username: str, lab_name: str, submission_hash: str) -> RunResult | None:
+    if not config_obj.use_result_cache:
+        return None
+    cache_path = get_result_cache_path(config_obj, username, lab_name)
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cached = json.load(cache_file)
+        if cached.get('submission_hash') != submission_hash:
+            return None
+        return RunResult(**cached['run_result'])
+    # a missing or unreadable cache just means we compile again
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+# Only the most recent attempt is kept per user and lab
+def store_cached_run_result(config_obj: Config, username: str, lab_name: str, submission_hash: str, run_result: RunResult):
+    if not config_obj.use_result_cache:
+        return
+    cache_path = get_result_cache_path(config_obj, username, lab_name)
+    try:
+        os.makedirs(config_obj.result_cache_directory, exist_ok=True)
+        with open(cache_path, 'w') as cache_file:
+            json.dump({'submission_hash': submission_hash, 'run_result': vars(run_result)}, cache_file)
+    except OSError:
+        print(f"{Fore.YELLOW}*** Warning: unable to save results to {cache_path}. ***{Style.RESET_ALL}")
+
+
 
 # Creates a new toml file.
 def prepare_toml_doc():
@@ -284,6 +375,9 @@ def prepare_toml_doc():
     _ = general.add(comment("Checks for a C header file corresponding to the lab name in the submission."))
     _ = general.add("check_lab_header", True)
     _ = general.add("run_valgrind", True)
+    _ = general.add(comment("Reuses the previous run and valgrind results when a student resubmits an identical file."))
+    _ = general.add(comment("The submission is still compiled every time, since that decides whether it's valid."))
+    _ = general.add("use_result_cache", True)
     
     paths = table()
     _ = paths.add("base_path", "/cluster/pixstor/class/")
@@ -297,6 +391,8 @@ def prepare_toml_doc():
     _ = paths.add(comment("All invalid submissions go here within your grader's submission folder."))
     _ = paths.add(comment("If it doesn't exist, it will be created."))
     _ = paths.add("invalid_dir", ".invalid")
+    _ = paths.add(comment("Where cached compile/run results are kept for each student. ~ expands to the student's home directory."))
+    _ = paths.add("result_cache_directory", "~/.cache/mucsmake")
     doc['general'] = general
     doc['paths'] = paths
 
@@ -318,7 +414,8 @@ def prepare_config_obj():
 
     return Config(class_code = general.get('class_code'), run_valgrind = general.get('run_valgrind'), 
     base_path = paths.get('base_path'), lab_submission_directory = paths.get('lab_submission_directory'), test_files_directory = paths.get('test_files_directory'),
-    roster_directory = paths.get('roster_directory'), lab_window_path = paths.get('lab_window_path'), valid_dir = paths.get('valid_dir'), invalid_dir = paths.get('invalid_dir'))
+    roster_directory = paths.get('roster_directory'), lab_window_path = paths.get('lab_window_path'), valid_dir = paths.get('valid_dir'), invalid_dir = paths.get('invalid_dir'),
+    use_result_cache = general.get('use_result_cache', True), result_cache_directory = paths.get('result_cache_directory', "~/.cache/mucsmake"))
 
 
 if __name__ == "__main__":
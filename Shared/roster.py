@@ -0,0 +1,124 @@
+# Shared roster utilities
+# Used by both LabBackup and MUCSMake to read the grader CSV rosters
+# Rosters follow the schema ['pawprint', 'canvas_id', 'name', 'date'] with a header line.
+
+import mmap
+import os
+import re
+from array import array
+from csv import reader
+from typing import Iterator
+
+FIELDNAMES = ['pawprint', 'canvas_id', 'name', 'date']
+
+_pawprint_sanitizer = re.compile(r'\W+')
+
+
+class RosterEntry:
+    __slots__ = ('pawprint', 'canvas_id', 'name', 'date')
+
+    def __init__(self, pawprint: str, canvas_id: int, name: str, date: str):
+        self.pawprint = pawprint
+        self.canvas_id = canvas_id
+        self.name = name
+        self.date = date
+
+    def __repr__(self):
+        return f"RosterEntry({self.pawprint!r}, {self.canvas_id!r}, {self.name!r}, {self.date!r})"
+
+
+class RosterColumns:
+    """
+    Columnar form of a roster. Pawprints and Canvas IDs are stored as parallel arrays
+    with a hash index on pawprint, so lookups don't need to rescan the file.
+    """
+    __slots__ = ('pawprints', 'canvas_ids', 'names', 'dates', '_index')
+
+    def __init__(self):
+        self.pawprints: list[str] = []
+        self.canvas_ids = array('q')
+        self.names: list[str] = []
+        self.dates: list[str] = []
+        self._index: dict[str, int] = {}
+
+    def append(self, entry: RosterEntry):
+        self._index[entry.pawprint] = len(self.pawprints)
+        self.pawprints.append(entry.pawprint)
+        self.canvas_ids.append(entry.canvas_id)
+        self.names.append(entry.name)
+        self.dates.append(entry.date)
+
+    def __len__(self):
+        return len(self.pawprints)
+
+    def __contains__(self, pawprint: str):
+        return pawprint in self._index
+
+    def __iter__(self) -> Iterator[RosterEntry]:
+        for i in range(len(self.pawprints)):
+            yield self.entry(i)
+
+    def entry(self, i: int) -> RosterEntry:
+        return RosterEntry(self.pawprints[i], self.canvas_ids[i], self.names[i], self.dates[i])
+
+    def lookup(self, pawprint: str) -> RosterEntry | None:
+        i = self._index.get(pawprint)
+        if i is None:
+            return None
+        return self.entry(i)
+
+
+# Strips anything that isn't a word character out of a pawprint (whitespace, newlines, stray punctuation)
+def sanitize_pawprint(pawprint: str) -> str:
+    return _pawprint_sanitizer.sub('', pawprint)
+
+
+def _parse_canvas_id(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return -1
+
+
+def _mapped_lines(mapped: mmap.mmap) -> Iterator[str]:
+    readline = mapped.readline
+    line = readline()
+    while line:
+        yield line.decode('utf-8')
+        line = readline()
+
+
+# Streams a roster CSV one entry at a time without loading the whole file.
+# The header line is skipped. Empty or missing rosters yield nothing.
+def read_roster(path: str) -> Iterator[RosterEntry]:
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        lines = _mapped_lines(mapped)
+        next(lines, None)  # consume header
+        for row in reader(lines):
+            if not row:
+                continue
+            row += [''] * (len(FIELDNAMES) - len(row))
+            yield RosterEntry(sanitize_pawprint(row[0]), _parse_canvas_id(row[1]), row[2], row[3])
+
+
+_columns_cache: dict[str, tuple[tuple[int, int], RosterColumns]] = {}
+
+
+# Returns the columnar form of a roster, reusing the previous result if the file hasn't changed since.
+def load_roster_columns(path: str) -> RosterColumns:
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _columns_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    columns = RosterColumns()
+    for entry in read_roster(path):
+        columns.append(entry)
+    _columns_cache[path] = (key, columns)
+    return columns
@@ -0,0 +1,208 @@
+# Shared valgrind utilities
+# Runs valgrind with XML output and turns it into structured error and leak records.
+# Used by both LabBackup and MUCSMake instead of searching valgrind's text output.
+
+from subprocess import PIPE, run
+from typing import Iterator
+from xml.etree.ElementTree import Element, ParseError, iterparse
+
+
+class ValgrindFrame:
+    __slots__ = ('fn', 'file', 'line', 'obj')
+
+    def __init__(self, fn: str, file: str, line: int, obj: str):
+        self.fn = fn
+        self.file = file
+        self.line = line
+        self.obj = obj
+
+    def key(self) -> tuple:
+        return (self.fn, self.file, self.line, self.obj)
+
+    def __str__(self):
+        if self.file:
+            return f"{self.fn or '???'} ({self.file}:{self.line})"
+        return f"{self.fn or '???'} (in {self.obj})"
+
+
+class ValgrindError:
+    __slots__ = ('kind', 'message', 'stack_id', 'count')
+
+    def __init__(self, kind: str, message: str, stack_id: int, count: int = 1):
+        self.kind = kind
+        self.message = message
+        self.stack_id = stack_id
+        self.count = count
+
+
+class ValgrindLeak:
+    __slots__ = ('kind', 'message', 'stack_id', 'leaked_bytes', 'leaked_blocks')
+
+    def __init__(self, kind: str, message: str, stack_id: int, leaked_bytes: int, leaked_blocks: int):
+        self.kind = kind
+        self.message = message
+        self.stack_id = stack_id
+        self.leaked_bytes = leaked_bytes
+        self.leaked_blocks = leaked_blocks
+
+
+class ValgrindReport:
+    """
+    Errors and leaks from a single valgrind run. Stack traces are stored once in `stacks`
+    and referenced by index, so repeated errors from the same call site share one trace.
+    `complete` is False if the XML was cut short (e.g. valgrind was killed by a timeout).
+    """
+
+    def __init__(self):
+        self.errors: list[ValgrindError] = []
+        self.leaks: list[ValgrindLeak] = []
+        self.stacks: list[tuple[ValgrindFrame, ...]] = []
+        self.complete = True
+        self.log = ""
+        self._stack_index: dict[tuple, int] = {}
+        self._error_index: dict[tuple[str, int], ValgrindError] = {}
+        self._leak_index: dict[tuple[str, int], ValgrindLeak] = {}
+
+    @property
+    def has_errors(self) -> bool:
+        return len(self.errors) > 0
+
+    @property
+    def has_leaks(self) -> bool:
+        return len(self.leaks) > 0
+
+    @property
+    def error_count(self) -> int:
+        return sum(error.count for error in self.errors)
+
+    @property
+    def leaked_bytes(self) -> int:
+        return sum(leak.leaked_bytes for leak in self.leaks)
+
+    def intern_stack(self, frames: tuple[ValgrindFrame, ...]) -> int:
+        key = tuple(frame.key() for frame in frames)
+        stack_id = self._stack_index.get(key)
+        if stack_id is None:
+            stack_id = len(self.stacks)
+            self._stack_index[key] = stack_id
+            self.stacks.append(frames)
+        return stack_id
+
+    def add_error(self, kind: str, message: str, stack_id: int, count: int):
+        existing = self._error_index.get((kind, stack_id))
+        if existing is not None:
+            existing.count += count
+            return
+        error = ValgrindError(kind, message, stack_id, count)
+        self._error_index[(kind, stack_id)] = error
+        self.errors.append(error)
+
+    def add_leak(self, kind: str, message: str, stack_id: int, leaked_bytes: int, leaked_blocks: int):
+        existing = self._leak_index.get((kind, stack_id))
+        if existing is not None:
+            existing.leaked_bytes += leaked_bytes
+            existing.leaked_blocks += leaked_blocks
+            return
+        leak = ValgrindLeak(kind, message, stack_id, leaked_bytes, leaked_blocks)
+        self._leak_index[(kind, stack_id)] = leak
+        self.leaks.append(leak)
+
+    def summary(self) -> str:
+        return f"{self.error_count} error(s), {self.leaked_bytes} byte(s) leaked in {len(self.leaks)} location(s)"
+
+    def _render_stack(self, stack_id: int) -> list[str]:
+        return [("   at " if i == 0 else "   by ") + str(frame) for i, frame in enumerate(self.stacks[stack_id])]
+
+    # Human readable report, since in XML mode valgrind leaves the errors themselves out of its text output
+    def render(self) -> str:
+        lines = []
+        for error in self.errors:
+            repeats = f" (happened {error.count} times)" if error.count > 1 else ""
+            lines.append(f"{error.kind}: {error.message}{repeats}")
+            lines += self._render_stack(error.stack_id)
+            lines.append("")
+        for leak in self.leaks:
+            lines.append(f"{leak.kind}: {leak.message}")
+            lines += self._render_stack(leak.stack_id)
+            lines.append("")
+        if not self.errors and not self.leaks:
+            lines.append("No errors or leaks found.")
+            lines.append("")
+        lines.append("Summary: " + self.summary())
+        if not self.complete:
+            lines.append("Warning: valgrind's output was incomplete, so this report may be missing errors or leaks.")
+        if self.log.strip():
+            lines.append("")
+            lines.append("valgrind output:")
+            lines.append(self.log.rstrip())
+        return "\n".join(lines) + "\n"
+
+
+def _int_text(element: Element | None, default: int = 0) -> int:
+    if element is None or element.text is None:
+        return default
+    try:
+        return int(element.text, 0)
+    except ValueError:
+        return default
+
+
+def _parse_stack(stack: Element | None) -> tuple[ValgrindFrame, ...]:
+    if stack is None:
+        return ()
+    return tuple(ValgrindFrame(frame.findtext('fn', ''), frame.findtext('file', ''), _int_text(frame.find('line')),
+                               frame.findtext('obj', ''))
+                 for frame in stack.iterfind('frame'))
+
+
+# Walks the XML incrementally, yielding each top level element once it has been fully read
+def _iter_valgrind_elements(xml_path: str) -> Iterator[Element]:
+    depth = 0
+    for event, element in iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield element
+            element.clear()
+
+
+# Parses a valgrind --xml=yes output file into a ValgrindReport
+def parse_valgrind_xml(xml_path: str) -> ValgrindReport:
+    report = ValgrindReport()
+    # valgrind reports how many times each unique error happened separately from the error itself
+    counts: dict[int, int] = {}
+    pending_errors: list[tuple[str, str, int, int]] = []
+    try:
+        for element in _iter_valgrind_elements(xml_path):
+            if element.tag == 'error':
+                kind = element.findtext('kind', '')
+                message = element.findtext('what') or element.findtext('xwhat/text', '')
+                stack_id = report.intern_stack(_parse_stack(element.find('stack')))
+                if kind.startswith('Leak_'):
+                    report.add_leak(kind, message, stack_id, _int_text(element.find('xwhat/leakedbytes')),
+                                    _int_text(element.find('xwhat/leakedblocks')))
+                else:
+                    pending_errors.append((kind, message, stack_id, _int_text(element.find('unique'), -1)))
+            elif element.tag == 'errorcounts':
+                for pair in element.iterfind('pair'):
+                    counts[_int_text(pair.find('unique'), -1)] = _int_text(pair.find('count'), 1)
+    except (ParseError, OSError):
+        report.complete = False
+    for kind, message, stack_id, unique in pending_errors:
+        report.add_error(kind, message, stack_id, counts.get(unique, 1))
+    return report
+
+
+# Runs an executable under valgrind with XML output written to xml_path and returns the parsed report.
+# Anything valgrind still prints as text (e.g. if it fails to start) is kept on the report as `log`.
+# Raises TimeoutExpired if the program runs longer than timeout.
+def run_valgrind(executable_path, xml_path: str, timeout: float | None = None, input_string: str | None = None,
+                 cwd: str | None = None) -> ValgrindReport:
+    result = run(["valgrind", "--xml=yes", "--xml-file=" + str(xml_path), "--leak-check=full",
+                  "--show-leak-kinds=all", executable_path], timeout=timeout, stdout=PIPE, stderr=PIPE,
+                 universal_newlines=True, input=input_string, cwd=cwd)
+    report = parse_valgrind_xml(str(xml_path))
+    report.log = result.stderr
+    return report